@@ -1,11 +1,67 @@
 #!/usr/bin/env python
 """MQTT client producing data."""
 
-import queue
+import collections
+import socket
+import struct
 import threading
+import time
 
 import paho.mqtt.client as mqtt
 
+# queue sentinel telling the queue publisher thread to pause until the next run
+_STOP = object()
+
+
+def _payload_bytes(payload):
+    """Convert a payload to bytes in the same way as mqtt.Client.publish."""
+    if isinstance(payload, str):
+        return payload.encode("utf-8")
+    elif isinstance(payload, (bytes, bytearray)):
+        return payload
+    elif isinstance(payload, (int, float)):
+        return str(payload).encode("ascii")
+    elif payload is None:
+        return b""
+    else:
+        raise TypeError("payload must be a string, bytearray, int, float or None.")
+
+
+def split_batch(payload):
+    """Split a batched message payload into its component payloads.
+
+    Batched payloads are the concatenation of each component payload prefixed by its
+    length in bytes as a 4-byte big-endian unsigned integer.
+
+    payload : bytes
+        Payload of a message published from a batch.
+
+    Returns
+    -------
+    payloads : list of bytes
+        Component payloads in the order they were appended to the queue.
+
+    Raises
+    ------
+    ValueError
+        If the payload is truncated or isn't a batch.
+    """
+    payloads = []
+    offset = 0
+    while offset < len(payload):
+        if offset + 4 > len(payload):
+            raise ValueError(f"Invalid batch: incomplete length prefix at {offset}.")
+        (length,) = struct.unpack_from("!I", payload, offset)
+        offset += 4
+        if offset + length > len(payload):
+            raise ValueError(
+                f"Invalid batch: payload of length {length} at {offset} runs past the "
+                "end of the batch."
+            )
+        payloads.append(bytes(payload[offset : offset + length]))
+        offset += length
+    return payloads
+
 
 class MQTTQueuePublisher(mqtt.Client):
     """MQTT client that publishes data to a topic from its own queue.
@@ -16,14 +72,111 @@ class MQTTQueuePublisher(mqtt.Client):
     concurrently without blocking the main program producing data.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        max_inflight=100,
+        max_batch_size=1048576,
+        maxsize=0,
+        latency_threshold=0,
+        sndbuf=1048576,
+        overflow="block",
+        on_overflow=None,
+        _queue_from=None,
+    ):
         """Construct MQTT client, inheriting from mqtt.Client.
 
         Callback and connect methods are not automatically run here. They should be
         called in the same way as for the base mqtt.Client.
+
+        max_inflight : int
+            Maximum number of QoS > 0 messages that can be awaiting acknowledgement
+            from the broker before the queue publisher blocks.
+        max_batch_size : int
+            Maximum size in bytes of a batched message payload.
+        maxsize : int
+            Maximum number of messages in the queue. What happens when the queue is
+            full is set by `overflow`. If `maxsize` <= 0, the queue size is unbounded.
+        latency_threshold : int
+            If fewer than this many messages are waiting in the queue, the queue
+            publisher waits for each message to be acknowledged before publishing the
+            next. Above the threshold messages are pipelined up to `max_inflight`.
+        sndbuf : int
+            Size in bytes of the socket send buffer requested on each (re)connection.
+            If `sndbuf` <= 0, the operating system default is used.
+        overflow : {"block", "drop_oldest", "drop_new"}
+            Behaviour of `append_payload` when the queue is full: "block" waits until
+            the queue publisher frees a slot, "drop_oldest" discards the message at
+            the front of the queue, and "drop_new" discards the message being
+            appended.
+        on_overflow : callable
+            Called as `on_overflow(topic, payload, retain, qos)` with each message
+            discarded because the queue was full, e.g. to log it or save it to disk.
+            `payload` is passed as bytes, converted from the appended payload in the
+            same way as mqtt.Client.publish.
+
+        Sharing a queue between publishers is only supported through
+        `MQTTQueuePublisherPool`, which stops all of them together.
         """
         super().__init__()
-        self._start_q()
+        if overflow not in ("block", "drop_oldest", "drop_new"):
+            raise ValueError(
+                f"Invalid overflow: {overflow}. Must be 'block', 'drop_oldest', or "
+                "'drop_new'."
+            )
+        self._max_inflight = max_inflight
+        self._max_batch_size = max_batch_size
+        self._maxsize = maxsize
+        self._overflow = overflow
+        self._on_overflow = on_overflow
+        self._latency_threshold = latency_threshold
+        self._sndbuf = sndbuf
+        self.max_inflight_messages_set(max_inflight)
+        # queueing is handled by this class so don't let the client drop messages
+        self.max_queued_messages_set(0)
+        # don't let a long reconnect backoff stall the queue
+        self.reconnect_delay_set(min_delay=1, max_delay=16)
+        self._start_q(_queue_from)
+
+    @property
+    def on_publish(self):
+        """Get the publish callback.
+
+        The queue publisher needs to be notified of completed publishes to keep track
+        of messages in flight so the user callback is wrapped.
+        """
+        return self._handle_publish
+
+    @on_publish.setter
+    def on_publish(self, func):
+        """Set the user publish callback, called in the same way as mqtt.Client."""
+        self._on_publish = func
+
+    def _handle_publish(self, client, userdata, mid):
+        """Hand completed mid to the queue publisher then call user callback.
+
+        This is called by the network thread while it holds the client's internal
+        locks so it mustn't block on anything the queue publisher holds while
+        publishing. The queue publisher matches completed mids to its own pending
+        messages.
+        """
+        self._published.append(mid)
+        self._publish_done.set()
+
+        if self._on_publish is not None:
+            self._on_publish(client, userdata, mid)
+
+    def reconnect(self):
+        """Reconnect the client and set the socket send buffer size.
+
+        All connection methods of mqtt.Client, including automatic reconnects by the
+        network loop, go through this method.
+        """
+        rc = super().reconnect()
+        sock = self.socket()
+        # websocket transports wrap the socket and don't support socket options
+        if self._sndbuf > 0 and isinstance(sock, socket.socket):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._sndbuf)
+        return rc
 
     def __enter__(self):
         """Enter the runtime context related to this object."""
@@ -36,56 +189,463 @@ class MQTTQueuePublisher(mqtt.Client):
         """
         self.stop()
 
-    def stop(self):
-        """Stop the queue publisher."""
-        # wait for all messages to be published
-        while True:
-            if self._q.empty() is True:
-                break
+    def run(self, *args, **kwargs):
+        """Connect to the broker, start the network loop, and resume the queue.
+
+        Messages appended while the queue publisher was stopped are published once
+        it resumes.
+
+        Arguments are passed to `mqtt.Client.connect`.
+        """
+        self.connect(*args, **kwargs)
+        self.loop_start()
+        self._running.set()
+
+    def stop(self, timeout=None):
+        """Stop the queue publisher.
+
+        The queue publisher thread is paused rather than exited so it can be resumed
+        by `run`. Messages appended while stopped stay queued.
+
+        timeout : float
+            Maximum time in seconds to wait for queued messages to be published and
+            acknowledged. If `None`, wait until they are, the client disconnects, or
+            the queue publisher thread dies.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._pause_queue_publishers([self], deadline)
         self.loop_stop()
         self.disconnect()
 
+    @staticmethod
+    def _pause_queue_publishers(clients, deadline):
+        """Pause the queue publisher threads of clients sharing a queue.
+
+        clients : list of MQTTQueuePublisher
+            Clients sharing a queue. All of them must be paused together because a
+            queue publisher thread pauses on the first sentinel it takes.
+        deadline : float
+            Time from `time.monotonic` to give up waiting at. If `None`, wait until
+            messages in flight are acknowledged, the client disconnects, or the queue
+            publisher thread dies.
+        """
+        # a paused publisher thread won't take a sentinel
+        running = [client for client in clients if client._running.is_set()]
+        for client in running:
+            client._running.clear()
+            client._paused.clear()
+            client._stop_deadline = deadline
+        # one sentinel per running publisher thread at the back of the queue so the
+        # threads pause after publishing everything queued before them
+        q = clients[0]._q
+        for _ in running:
+            q.append(_STOP)
+        clients[0]._not_empty.set()
+        # the publisher threads wait for messages in flight to be acknowledged
+        # before pausing
+        for client in running:
+            client._wait_paused(deadline)
+
+    def _wait_paused(self, deadline):
+        """Wait for the queue publisher thread to pause.
+
+        deadline : float
+            Time from `time.monotonic` to give up waiting at. If `None`, only give up
+            if the queue publisher thread dies.
+
+        Returns
+        -------
+        paused : bool
+            Flag whether or not the queue publisher thread paused.
+        """
+        while True:
+            if deadline is None:
+                wait = 0.1
+            else:
+                wait = min(0.1, deadline - time.monotonic())
+                if wait <= 0:
+                    return self._paused.is_set()
+            if self._paused.wait(wait):
+                return True
+            if not self._worker.is_alive():
+                return False
+
+    def __len__(self):
+        """Get current length of queue."""
+        return len(self._q)
+
+    def __bool__(self):
+        """Keep the client truthy when its queue is empty."""
+        return True
+
     @property
     def q_size(self):
-        """Get current length of queue."""
-        return self._q.qsize()
+        """Get current length of queue, same as `len`."""
+        return len(self._q)
 
-    def _start_q(self):
+    def _start_q(self, queue_from=None):
         """Start queue and mqtt client threads.
 
         The MQTT client publishes data to a topic from its own queue.
 
-        topic : str
-            MQTT topic to publish to.
+        queue_from : MQTTQueuePublisher
+            Queue publisher to share a queue with. If `None`, a new queue is created.
         """
-        self._q = queue.Queue()
-        threading.Thread(target=self._queue_publisher, daemon=True).start()
+        if queue_from is None:
+            self._q = collections.deque()
+            self._not_empty = threading.Event()
+            if self._maxsize > 0 and self._overflow == "block":
+                self._slots = threading.Semaphore(self._maxsize)
+            else:
+                self._slots = None
+        else:
+            self._q = queue_from._q
+            self._not_empty = queue_from._not_empty
+            self._slots = queue_from._slots
+            self._maxsize = queue_from._maxsize
+            self._overflow = queue_from._overflow
+            self._on_overflow = queue_from._on_overflow
+        # bound once for the producer's hot path in `append_payload`
+        self._q_append = self._q.append
+        # mids of completed publishes, appended by the publish callback
+        self._published = collections.deque()
+        self._publish_done = threading.Event()
+        # the queue publisher runs straight away to support connecting in the same
+        # way as mqtt.Client as well as with `run`
+        self._running = threading.Event()
+        self._running.set()
+        self._paused = threading.Event()
+        self._stop_deadline = None
+        self._worker = threading.Thread(target=self._queue_publisher, daemon=True)
+        self._worker.start()
 
     def _queue_publisher(self):
-        """Publish elements in the queue.
+        """Publish elements in the queue."""
+        # bind names used on every iteration to locals to avoid attribute lookups
+        q = self._q
+        popleft = q.popleft
+        not_empty = self._not_empty
+        slots = self._slots
+        publish = self.publish
+        published = self._published
+        max_inflight = self._max_inflight
+        latency_threshold = self._latency_threshold
+        running = self._running
+
+        # message info of queued messages awaiting acknowledgement, keyed by mid
+        pending = {}
+
+        while True:
+            try:
+                item = popleft()
+            except IndexError:
+                # queue drained, sleep until the next append. Re-check after clearing
+                # so an append that landed in between isn't missed.
+                not_empty.clear()
+                if not q:
+                    not_empty.wait()
+                continue
+            if item is _STOP:
+                self._wait_acknowledged(pending, self._stop_deadline)
+                self._paused.set()
+                self._running.wait()
+                continue
+            if slots is not None:
+                slots.release()
+            topic, payload, retain, qos, batchable = item
+            if batchable:
+                payload = self._drain_batch(topic, payload, retain, qos)
+            if published:
+                self._reap_published(pending)
+            if qos == 0:
+                # QoS 0 messages aren't acknowledged so don't count towards the
+                # in-flight limit
+                info = publish(topic, payload, 0, retain)
+            else:
+                # only block if the maximum number of messages are already in flight
+                if len(pending) >= max_inflight:
+                    self._wait_inflight(pending, max_inflight - 1)
+                info = publish(topic, payload, qos, retain)
+                pending[info.mid] = info
+            # in latency mode, don't start the next message until this one completes.
+            # wait_for_publish raises if the message couldn't be sent, e.g. while
+            # disconnected, so only wait on messages that were handed over. Stop
+            # waiting if the connection drops or a stop is requested, leaving the
+            # message to the in-flight window.
+            if len(q) < latency_threshold and info.rc == mqtt.MQTT_ERR_SUCCESS:
+                while not info.is_published():
+                    if not (running.is_set() and self.is_connected()):
+                        break
+                    info.wait_for_publish(0.1)
+
+    def _wait_inflight(self, pending, limit, timeout=None):
+        """Block until no more than `limit` pending messages are in flight.
+
+        pending : dict
+            Message info of messages awaiting acknowledgement, keyed by mid.
+        limit : int
+            Maximum number of messages left in flight on return.
+        timeout : float
+            Maximum time to wait in seconds. If `None`, wait until a stop is requested
+            while the client is disconnected, when acknowledgements can't arrive.
+
+        Returns
+        -------
+        done : bool
+            Flag whether or not no more than `limit` messages are in flight.
+        """
+        publish_done = self._publish_done
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            # clear before reaping so a callback that lands after the reap still
+            # wakes this thread
+            publish_done.clear()
+            self._reap_published(pending)
+            if len(pending) <= limit:
+                return True
+            if timeout is None:
+                # messages still in flight are resent by the client on reconnection
+                # so don't hold up a stop waiting for them
+                if not self._running.is_set() and not self.is_connected():
+                    return False
+                publish_done.wait(0.1)
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                publish_done.wait(remaining)
+
+    def _wait_acknowledged(self, pending, deadline):
+        """Wait for all messages in flight to be acknowledged before pausing.
+
+        Acknowledgements can't arrive while the client is disconnected so stop waiting
+        if it is. Messages still in flight are resent by the client on reconnection.
+
+        pending : dict
+            Message info of messages awaiting acknowledgement, keyed by mid.
+        deadline : float
+            Time from `time.monotonic` to give up waiting at. If `None`, wait until
+            all messages are acknowledged or the client disconnects.
+        """
+        while self.is_connected():
+            if deadline is None:
+                wait = 0.1
+            else:
+                wait = min(0.1, deadline - time.monotonic())
+                if wait <= 0:
+                    return
+            if self._wait_inflight(pending, 0, wait):
+                return
+
+    def _reap_published(self, pending):
+        """Remove messages reported complete by the publish callback from pending.
+
+        pending : dict
+            Message info of messages awaiting acknowledgement, keyed by mid.
+        """
+        popleft = self._published.popleft
+        while True:
+            try:
+                pending.pop(popleft(), None)
+            except IndexError:
+                return
+
+    def _drain_batch(self, topic, payload, retain, qos):
+        """Combine a payload with following batchable payloads for the same topic.
 
-        q : queue.Queue
-            Queue to publish from.
         topic : str
-            MQTT topic to publish to.
+            Topic to publish to.
+        payload : bytes
+            First payload of the batch.
+        retain : bool
+            Flag whether or not the message should be retained.
+        qos : int
+            Quality of service level to publish with.
+
+        Returns
+        -------
+        batch : bytes
+            Length-prefixed payloads, see `split_batch`.
         """
+        batch = bytearray(struct.pack("!I", len(payload)))
+        batch += payload
         while True:
-            topic, payload, retain = self._q.get()
-            # publish paylod with blocking wait for completion
-            self.publish(topic, payload, 2, retain).wait_for_publish()
-            self._q.task_done()
+            # pop rather than peek because the queue may be shared with other
+            # publisher threads, putting back anything that doesn't belong to the batch
+            try:
+                item = self._q.popleft()
+            except IndexError:
+                break
+            if item is _STOP:
+                self._q.appendleft(item)
+                break
+            next_topic, next_payload, next_retain, next_qos, next_batchable = item
+            if not (
+                next_batchable
+                and next_topic == topic
+                and next_retain == retain
+                and next_qos == qos
+            ):
+                self._q.appendleft(item)
+                break
+            if len(batch) + 4 + len(next_payload) > self._max_batch_size:
+                self._q.appendleft(item)
+                break
+            if self._slots is not None:
+                self._slots.release()
+            batch += struct.pack("!I", len(next_payload))
+            batch += next_payload
+        return bytes(batch)
 
-    def append_payload(self, topic, payload, retain=False):
+    def append_payload(self, topic, payload, retain=False, qos=1, batchable=False):
         """Append a payload to a queue.
 
-        payload : str
-            Message to be added to queue.
+        payload : str, bytes, bytearray, int, float, or None
+            Message to be added to queue. It's converted to bytes here, in the same
+            way as mqtt.Client.publish, so the queue publisher thread doesn't have to.
         topic : str
             Topic to publish to.
         retain : bool
             Flag whether or not the message should be retained.
+        qos : {0, 1, 2}
+            Quality of service level to publish with.
+        batchable : bool
+            Flag whether or not the payload can be combined with adjacent batchable
+            payloads for the same topic, retain flag, and QoS into a single message.
+            Batched messages are always framed, even if only one payload was queued,
+            and should be decoded by subscribers with `split_batch`.
+        """
+        # invalid messages would otherwise only fail on the queue publisher thread
+        if qos not in (0, 1, 2):
+            raise ValueError(f"Invalid QoS: {qos}. Must be 0, 1, or 2.")
+        payload = _payload_bytes(payload)
+        if self._slots is not None:
+            self._slots.acquire()
+        elif self._maxsize > 0 and len(self._q) >= self._maxsize:
+            if self._overflow == "drop_new":
+                self._handle_overflow((topic, payload, retain, qos, batchable))
+                return
+            self._drop_oldest()
+        self._q_append((topic, payload, retain, qos, batchable))
+        # the publisher only waits on the event once it has drained the queue so only
+        # take the event's lock to wake it up
+        if not self._not_empty.is_set():
+            self._not_empty.set()
+
+    def _drop_oldest(self):
+        """Discard the message at the front of a full queue.
+
+        Stop sentinels at the front of the queue keep their place and the first
+        message behind them is discarded instead. If only sentinels are queued,
+        nothing is discarded and the queue can exceed its maximum size by the
+        message being appended.
+        """
+        stops = 0
+        while True:
+            try:
+                item = self._q.popleft()
+            except IndexError:
+                # the queue publisher emptied the queue in the meantime
+                item = None
+                break
+            if item is not _STOP:
+                break
+            stops += 1
+        for _ in range(stops):
+            self._q.appendleft(_STOP)
+        if item is not None:
+            self._handle_overflow(item)
+
+    def _handle_overflow(self, item):
+        """Pass a message discarded from a full queue to the overflow callback.
+
+        item : tuple
+            Queued message.
+        """
+        if self._on_overflow is not None:
+            topic, payload, retain, qos, _ = item
+            self._on_overflow(topic, payload, retain, qos)
+
+
+class MQTTQueuePublisherPool:
+    """Pool of MQTT queue publishers sharing a single queue.
+
+    Each publisher has its own connection to the broker and its own queue publisher
+    thread, all taking messages from the same queue. This can increase throughput
+    when a single connection can't keep up with the rate data is produced. Messages
+    published by different connections may arrive out of order.
+    """
+
+    def __init__(self, n, **kwargs):
+        """Construct the pool of MQTT queue publishers.
+
+        The publishers share a queue so they must be stopped together with `stop`
+        rather than individually.
+
+        n : int
+            Number of publishers in the pool.
+        **kwargs
+            Keyword arguments passed to each `MQTTQueuePublisher`.
+        """
+        if n < 1:
+            raise ValueError(f"Invalid number of publishers: {n}. Must be at least 1.")
+        first = MQTTQueuePublisher(**kwargs)
+        self.clients = [first] + [
+            MQTTQueuePublisher(_queue_from=first, **kwargs) for _ in range(n - 1)
+        ]
+
+    def __enter__(self):
+        """Enter the runtime context related to this object."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Exit the runtime context related to this object.
+
+        Make sure everything gets cleaned up properly.
+        """
+        self.stop()
+
+    def run(self, *args, **kwargs):
+        """Connect all publishers to the broker and start or resume publishing.
+
+        Arguments are passed to `mqtt.Client.connect` for each publisher.
+        """
+        for client in self.clients:
+            client.run(*args, **kwargs)
+
+    def stop(self, timeout=None):
+        """Stop all queue publishers.
+
+        timeout : float
+            Maximum time in seconds to wait for queued messages to be published and
+            acknowledged, see `MQTTQueuePublisher.stop`.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.clients[0]._pause_queue_publishers(self.clients, deadline)
+        for client in self.clients:
+            client.loop_stop()
+            client.disconnect()
+
+    def __len__(self):
+        """Get current length of queue."""
+        return len(self.clients[0]._q)
+
+    def __bool__(self):
+        """Keep the pool truthy when its queue is empty."""
+        return True
+
+    @property
+    def q_size(self):
+        """Get current length of queue, same as `len`."""
+        return len(self.clients[0]._q)
+
+    def append_payload(self, topic, payload, retain=False, qos=1, batchable=False):
+        """Append a payload to the shared queue.
+
+        See `MQTTQueuePublisher.append_payload`.
         """
-        self._q.put_nowait([topic, payload, retain])
+        self.clients[0].append_payload(topic, payload, retain, qos, batchable)
 
 
 if __name__ == "__main__":
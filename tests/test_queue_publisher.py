@@ -0,0 +1,458 @@
+"""Tests for the MQTT queue publisher."""
+
+import itertools
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from mqtt_tools import queue_publisher
+from mqtt_tools.queue_publisher import (
+    MQTTQueuePublisher,
+    MQTTQueuePublisherPool,
+    split_batch,
+)
+
+
+def _make_publisher(**kwargs):
+    """Make a queue publisher whose queue publisher thread is paused.
+
+    With the queue publisher paused, queued messages stay put so batches can be
+    drained directly.
+    """
+    publisher = MQTTQueuePublisher(**kwargs)
+    publisher.stop()
+    return publisher
+
+
+def _drain_first_batch(publisher):
+    """Drain a batch starting at the front of the queue."""
+    topic, payload, retain, qos, _ = publisher._q.popleft()
+    return publisher._drain_batch(topic, payload, retain, qos)
+
+
+def _wait_for(condition, timeout=2):
+    """Poll a condition set by the queue publisher thread until it holds."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class _RecordingPublisher(MQTTQueuePublisher):
+    """Queue publisher that appears connected and records what it publishes.
+
+    Nothing is acknowledged until a test calls `acknowledge`.
+    """
+
+    _mids = itertools.count(1)
+
+    def __init__(self, **kwargs):
+        self.sent = []
+        self.unacknowledged = set()
+        self.max_unacknowledged = 0
+        super().__init__(**kwargs)
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        info = mqtt.MQTTMessageInfo(next(self._mids))
+        self.sent.append((payload, qos, info.mid))
+        if qos > 0:
+            self.unacknowledged.add(info.mid)
+            self.max_unacknowledged = max(
+                self.max_unacknowledged, len(self.unacknowledged)
+            )
+        return info
+
+    def acknowledge(self, mid):
+        """Acknowledge a message in the same way as the network thread."""
+        self.unacknowledged.discard(mid)
+        self.on_publish(self, None, mid)
+
+
+def test_inflight_window():
+    """No more than max_inflight QoS > 0 messages are awaiting acknowledgement."""
+    publisher = _RecordingPublisher(max_inflight=2)
+    for i in range(5):
+        publisher.append_payload("t", str(i).encode(), qos=1)
+
+    assert _wait_for(lambda: len(publisher.sent) == 2)
+    time.sleep(0.1)
+    assert len(publisher.sent) == 2
+
+    # each acknowledgement frees a slot for one more message
+    while len(publisher.sent) < 5:
+        n = len(publisher.sent)
+        publisher.acknowledge(min(publisher.unacknowledged))
+        assert _wait_for(lambda: len(publisher.sent) == n + 1)
+    for mid in list(publisher.unacknowledged):
+        publisher.acknowledge(mid)
+
+    publisher.stop(timeout=2)
+
+    payloads = [payload for payload, *_ in publisher.sent]
+    assert payloads == [b"0", b"1", b"2", b"3", b"4"]
+    assert publisher.max_unacknowledged == 2
+    assert publisher._paused.is_set()
+
+
+def test_inflight_window_skips_qos0():
+    """QoS 0 messages aren't held up by a full in-flight window."""
+    publisher = _RecordingPublisher(max_inflight=1)
+    publisher.append_payload("t", b"a", qos=1)
+    for payload in (b"b", b"c", b"d"):
+        publisher.append_payload("t", payload, qos=0)
+    publisher.append_payload("t", b"e", qos=1)
+
+    assert _wait_for(lambda: len(publisher.sent) == 4)
+    time.sleep(0.1)
+    assert [payload for payload, *_ in publisher.sent] == [b"a", b"b", b"c", b"d"]
+
+    publisher.acknowledge(publisher.sent[0][2])
+
+    assert _wait_for(lambda: len(publisher.sent) == 5)
+    publisher.acknowledge(publisher.sent[4][2])
+    publisher.stop(timeout=2)
+    assert publisher.max_unacknowledged == 1
+
+
+def test_user_on_publish_callback():
+    """A publish callback set by the user is still called."""
+    publisher = _RecordingPublisher()
+    calls = []
+    publisher.on_publish = lambda client, userdata, mid: calls.append((client, mid))
+    publisher.append_payload("t", b"a", qos=1)
+    assert _wait_for(lambda: publisher.sent)
+
+    mid = publisher.sent[0][2]
+    publisher.acknowledge(mid)
+    publisher.stop(timeout=2)
+
+    assert calls == [(publisher, mid)]
+    assert publisher._paused.is_set()
+
+
+def test_split_batch_round_trip():
+    """Batched payloads split back into the original payloads in order."""
+    publisher = _make_publisher()
+    payloads = ["a", b"", b"\x00\x01\x02", "é", 3, 1.5]
+    for payload in payloads:
+        publisher.append_payload("t", payload, batchable=True)
+
+    batch = _drain_first_batch(publisher)
+
+    assert split_batch(batch) == [
+        b"a",
+        b"",
+        b"\x00\x01\x02",
+        b"\xc3\xa9",
+        b"3",
+        b"1.5",
+    ]
+    assert len(publisher) == 0
+
+
+def test_split_batch_empty():
+    """An empty payload has no component payloads."""
+    assert split_batch(b"") == []
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        # fewer than 4 bytes left for a length prefix
+        b"\x00\x00",
+        b"\x00\x00\x00\x01a\x00",
+        # length prefix longer than the remaining bytes
+        b"\x00\x00\x00\x05abc",
+        b"\x00\x00\x00\x01a\x00\x00\x00\x02b",
+    ],
+)
+def test_split_batch_malformed(payload):
+    """Truncated or malformed batches raise rather than returning partial payloads."""
+    with pytest.raises(ValueError):
+        split_batch(payload)
+
+
+def test_batch_size_limit():
+    """Payloads that would exceed the maximum batch size stay queued."""
+    # room for exactly two 3-byte payloads with their 4-byte length prefixes
+    publisher = _make_publisher(max_batch_size=14)
+    for payload in (b"abc", b"def", b"ghi"):
+        publisher.append_payload("t", payload, batchable=True)
+
+    batch = _drain_first_batch(publisher)
+
+    assert len(batch) == 14
+    assert split_batch(batch) == [b"abc", b"def"]
+    assert len(publisher) == 1
+    assert split_batch(_drain_first_batch(publisher)) == [b"ghi"]
+
+
+def test_batch_stops_at_different_message():
+    """Only adjacent batchable payloads with matching topic, retain and QoS batch."""
+    publisher = _make_publisher()
+    publisher.append_payload("t", b"a", batchable=True)
+    publisher.append_payload("t", b"b", batchable=True)
+    publisher.append_payload("u", b"c", batchable=True)
+    publisher.append_payload("t", b"d", batchable=True)
+
+    assert split_batch(_drain_first_batch(publisher)) == [b"a", b"b"]
+    assert len(publisher) == 2
+
+
+def _queued_payloads(publisher):
+    """Get the payloads of queued messages, skipping stop sentinels."""
+    return [item[1] for item in publisher._q if item is not queue_publisher._STOP]
+
+
+def test_overflow_drop_new():
+    """A full queue discards the message being appended."""
+    dropped = []
+    publisher = _make_publisher(
+        maxsize=2,
+        overflow="drop_new",
+        on_overflow=lambda *message: dropped.append(message),
+    )
+    for payload in ("a", "b", "c"):
+        publisher.append_payload("t", payload, qos=0)
+
+    assert _queued_payloads(publisher) == [b"a", b"b"]
+    assert dropped == [("t", b"c", False, 0)]
+
+
+def test_overflow_drop_oldest():
+    """A full queue discards the message at the front of the queue."""
+    dropped = []
+    publisher = _make_publisher(
+        maxsize=2,
+        overflow="drop_oldest",
+        on_overflow=lambda *message: dropped.append(message),
+    )
+    publisher.append_payload("t", "a", retain=True, qos=2)
+    publisher.append_payload("t", "b")
+    publisher.append_payload("u", "c")
+
+    assert _queued_payloads(publisher) == [b"b", b"c"]
+    assert dropped == [("t", b"a", True, 2)]
+
+
+def test_overflow_drop_oldest_behind_stop():
+    """A stop sentinel at the front of a full queue keeps its place."""
+    dropped = []
+    publisher = _make_publisher(
+        maxsize=2,
+        overflow="drop_oldest",
+        on_overflow=lambda *message: dropped.append(message),
+    )
+    publisher.append_payload("t", "a")
+    publisher.append_payload("t", "b")
+    publisher._q.appendleft(queue_publisher._STOP)
+
+    publisher.append_payload("t", "c")
+
+    assert publisher._q[0] is queue_publisher._STOP
+    assert _queued_payloads(publisher) == [b"b", b"c"]
+    assert dropped == [("t", b"a", False, 1)]
+
+
+def test_overflow_block():
+    """A full queue blocks the producer until the queue publisher frees a slot."""
+    publisher = _make_publisher(maxsize=1)
+    publisher.append_payload("t", "a")
+    producer = threading.Thread(
+        target=publisher.append_payload, args=("t", "b"), daemon=True
+    )
+    producer.start()
+    producer.join(0.2)
+    assert producer.is_alive()
+    assert _queued_payloads(publisher) == [b"a"]
+
+    # take a message in the same way as the queue publisher thread
+    publisher._q.popleft()
+    publisher._slots.release()
+    producer.join(2)
+
+    assert not producer.is_alive()
+    assert _queued_payloads(publisher) == [b"b"]
+
+
+def test_invalid_overflow():
+    """Unknown overflow policies are rejected."""
+    with pytest.raises(ValueError):
+        MQTTQueuePublisher(overflow="drop_all")
+
+
+def test_latency_mode_while_disconnected():
+    """Messages that fail to publish in latency mode don't kill the publisher."""
+    publisher = MQTTQueuePublisher(latency_threshold=10)
+    publisher.append_payload("t", b"a", qos=0)
+    publisher.append_payload("t", b"b", qos=0)
+
+    publisher.stop()
+
+    assert publisher._worker.is_alive()
+    assert len(publisher) == 0
+
+
+def test_append_payload_invalid_message():
+    """Invalid messages are rejected in the caller's thread and not queued."""
+    publisher = _make_publisher()
+
+    with pytest.raises(ValueError):
+        publisher.append_payload("t", b"a", qos=5)
+    with pytest.raises(TypeError):
+        publisher.append_payload("t", {"a": 1})
+
+    assert len(publisher) == 0
+
+
+class _UnacknowledgedPublisher(MQTTQueuePublisher):
+    """Queue publisher that appears connected but never gets acknowledgements."""
+
+    _mids = itertools.count(1)
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        return mqtt.MQTTMessageInfo(next(self._mids))
+
+
+class _DeadThreadPublisher(MQTTQueuePublisher):
+    """Queue publisher whose queue publisher thread dies straight away."""
+
+    def _queue_publisher(self):
+        raise RuntimeError("queue publisher died")
+
+
+class _BrokenPublisher(MQTTQueuePublisher):
+    """Queue publisher whose publish method always raises."""
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        raise RuntimeError("publish failed")
+
+
+def test_stop_not_connected():
+    """Stopping a client that never connected doesn't wait for acknowledgements."""
+    publisher = MQTTQueuePublisher()
+    publisher.append_payload("t", b"a", qos=1)
+
+    publisher.stop()
+
+    assert publisher._paused.is_set()
+
+
+class _DisconnectedPublisher(MQTTQueuePublisher):
+    """Queue publisher whose messages were sent before losing the connection."""
+
+    _mids = itertools.count(1)
+
+    def is_connected(self):
+        return False
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        return mqtt.MQTTMessageInfo(next(self._mids))
+
+
+def _stop_returns(publisher, timeout=5):
+    """Check stopping without a timeout returns rather than waiting forever."""
+    stopper = threading.Thread(target=publisher.stop, daemon=True)
+    stopper.start()
+    stopper.join(timeout)
+    return not stopper.is_alive()
+
+
+def test_stop_full_inflight_window_disconnected():
+    """Stopping doesn't wait on a full in-flight window after losing the connection."""
+    publisher = _DisconnectedPublisher(max_inflight=1)
+    publisher.append_payload("t", b"a", qos=1)
+    publisher.append_payload("t", b"b", qos=1)
+
+    assert _stop_returns(publisher)
+    assert publisher._paused.is_set()
+    assert len(publisher) == 0
+
+
+def test_stop_latency_mode_disconnected():
+    """Stopping doesn't wait on a latency mode message after losing the connection."""
+    publisher = _DisconnectedPublisher(latency_threshold=10)
+    publisher.append_payload("t", b"a", qos=1)
+
+    assert _stop_returns(publisher)
+    assert publisher._paused.is_set()
+
+
+def test_stop_timeout():
+    """Stopping gives up waiting for acknowledgements after the timeout."""
+    publisher = _UnacknowledgedPublisher()
+    publisher.append_payload("t", b"a", qos=1)
+
+    start = time.monotonic()
+    publisher.stop(timeout=0.2)
+
+    assert time.monotonic() - start < 2
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_stop_dead_publisher_thread():
+    """Stopping doesn't wait for a queue publisher thread that has died."""
+    publisher = _BrokenPublisher()
+    publisher.append_payload("t", b"a")
+    publisher._worker.join(1)
+
+    publisher.stop()
+
+    assert not publisher._worker.is_alive()
+
+
+# the client isn't fully constructed so paho's destructor complains
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnraisableExceptionWarning")
+def test_queue_from_is_private():
+    """Queues can only be shared through a pool, which stops its clients together."""
+    with pytest.raises(TypeError):
+        MQTTQueuePublisher(queue_from=MQTTQueuePublisher())
+    with pytest.raises(TypeError):
+        MQTTQueuePublisherPool(2, queue_from=MQTTQueuePublisher())
+
+
+@pytest.mark.parametrize("n", [0, -1])
+def test_pool_invalid_size(n):
+    """A pool needs at least one publisher."""
+    with pytest.raises(ValueError):
+        MQTTQueuePublisherPool(n)
+
+
+def test_pool_stop():
+    """Stopping a pool pauses every queue publisher thread after the queue drains."""
+    pool = MQTTQueuePublisherPool(3)
+    for i in range(10):
+        pool.append_payload("t", i, qos=0)
+
+    pool.stop(timeout=5)
+
+    assert all(client._paused.is_set() for client in pool.clients)
+    assert len(pool) == 0
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_pool_stop_dead_publisher_thread(monkeypatch):
+    """Stopping a pool doesn't wait for a queue publisher thread that has died."""
+
+    def make_publisher(**kwargs):
+        if kwargs.get("_queue_from") is None:
+            return MQTTQueuePublisher(**kwargs)
+        return _DeadThreadPublisher(**kwargs)
+
+    monkeypatch.setattr(queue_publisher, "MQTTQueuePublisher", make_publisher)
+    pool = queue_publisher.MQTTQueuePublisherPool(2)
+    pool.clients[1]._worker.join(1)
+
+    pool.stop(timeout=5)
+
+    assert pool.clients[0]._paused.is_set()